@@ -3,28 +3,56 @@
 # Version 1 with A from 0 to 100 every 10 steps
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
+import math
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import matplotlib.pyplot as plt
 
 
 def theory_probability(p: float, q: float, a_capital: int, b_capital: int) -> float:
     """
-    Function for calculating theoretical probability for specified p, q, player A capital, player B capital.
+    Function for calculating theoretical probability for specified p, q, player A capital, player B capital. Single
+    value version of theory_probability_vectorized (only ratio q / p matters, so p is normalized to p / (p + q)).
     :param p: Probability of winning by player A in single game turn
     :param q: Probability of winning by player B in single game turn
     :param a_capital: Capital of player A
     :param b_capital: Capital of player B
     :return: Probability to win by player A
     """
+    return float(theory_probability_vectorized(p / (p + q), a_capital, b_capital))
+
+
+def theory_probability_vectorized(p, a_capital, b_capital) -> np.ndarray:
+    """
+    Function for calculating theoretical probability for arrays of p, player A capital, player B capital (q = 1 - p).
+    Formula is evaluated in log space with ratio r = q / p, as min(r, 1)^a * (s^b - 1) / (s^(a+b) - 1) where
+    s = min(r, 1 / r), so huge capitals neither overflow nor underflow and p = 0, p = 1 fall into correct limits.
+    :param p: Probability of winning by player A in single game turn (number or array)
+    :param a_capital: Capital of player A (number or array)
+    :param b_capital: Capital of player B (number or array)
+    :return: Array with probability of player A going bankrupt, broadcast from given arguments
+    """
     # initial variables
-    capital_sum: int = a_capital + b_capital
+    p, a_capital, b_capital = np.broadcast_arrays(np.asarray(p, dtype=float),
+                                                  np.asarray(a_capital, dtype=float),
+                                                  np.asarray(b_capital, dtype=float))
+    shape: tuple = p.shape
+    p, a_capital, b_capital = p.ravel(), a_capital.ravel(), b_capital.ravel()
+    capital_sum = a_capital + b_capital
 
     # main function logic
-    if p == 0.5 and q == 0.5:
-        calculated_probability = 1 - (a_capital / capital_sum)
-    else:
-        calculated_probability = ((q / p) ** a_capital - (q / p) ** capital_sum) / (1 - (q / p) ** capital_sum)
-    return calculated_probability
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_ratio = np.log1p(-p) - np.log(p)  # ln(q / p)
+        log_smaller = -np.abs(log_ratio)  # ln(s), never positive
+        calculated_probability = np.expm1(b_capital * log_smaller)
+        calculated_probability /= np.expm1(capital_sum * log_smaller)
+        calculated_probability *= np.exp(a_capital * np.minimum(log_ratio, 0.0))
+        fair = log_ratio == 0  # p = q = 0.5
+        calculated_probability[fair] = (b_capital / capital_sum)[fair]
+    calculated_probability[b_capital == 0] = 0.0
+    calculated_probability[a_capital == 0] = 1.0
+    return calculated_probability.reshape(shape)
 
 
 def experimental_probability(iterations: int, a_capital: int, b_capital: int, p: float, q: float) -> float:
@@ -58,6 +86,166 @@ def experimental_probability(iterations: int, a_capital: int, b_capital: int, p:
     return a_loses / iterations
 
 
+def count_a_loses_vectorized(iterations: int, a_capital: int, b_capital: int, p: float, q: float,
+                             block_size: int = 64, rng: np.random.Generator = None) -> int:
+    """
+    Function for counting games lost by player A for specified p, q, player A capital, player B capital.
+    All games are played together in lockstep as NumPy arrays - every round advances each unfinished game by up to
+    block_size turns, finished games are masked out and only the remaining ones are carried to the next round.
+    :param iterations: Number of games
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability of winning by player A in single game turn
+    :param q: Probability of winning by player B in single game turn
+    :param block_size: Maximum number of turns performed for every unfinished game in single round
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Number of games in which player A went bankrupt
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    capital_sum: int = a_capital + b_capital
+    a_win_chance: float = p / (p + q)
+    capitals = np.full(iterations, a_capital, dtype=np.int32)  # player A capital in every unfinished game
+    a_loses: int = 0
+
+    # games which are already finished before the first turn
+    if a_capital == 0:
+        return iterations
+    if b_capital == 0:
+        return 0
+
+    # main function logic
+    while capitals.size:
+        turns = max(1, min(block_size, 2 ** 24 // capitals.size))  # keep single round under ~16M cells
+        steps = np.where(rng.random((turns, capitals.size)) < a_win_chance, 1, -1).astype(np.int32)
+        paths = capitals + np.cumsum(steps, axis=0, dtype=np.int32)  # capital after each turn of the round
+        hits = (paths == 0) | (paths == capital_sum)
+        finished = hits.any(axis=0)
+        first_hit = hits.argmax(axis=0)[finished]  # turn at which finished game hit 0 or capital sum
+        a_loses += int(np.count_nonzero(paths[first_hit, np.flatnonzero(finished)] == 0))
+        capitals = paths[-1, ~finished]
+    return a_loses
+
+
+def experimental_probability_vectorized(iterations: int, a_capital: int, b_capital: int, p: float, q: float,
+                                        block_size: int = 64, rng: np.random.Generator = None) -> float:
+    """
+    Function for calculating experimental probability for specified p, q, player A capital, player B capital, with
+    games played in lockstep by count_a_loses_vectorized.
+    :param iterations: Number of games
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability of winning by player A in single game turn
+    :param q: Probability of winning by player B in single game turn
+    :param block_size: Maximum number of turns performed for every unfinished game in single round
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Probability to win game by player A
+    """
+    return count_a_loses_vectorized(iterations, a_capital, b_capital, p, q, block_size, rng) / iterations
+
+
+def experimental_probability_tilted(iterations: int, a_capital: int, b_capital: int, p: float, q: float,
+                                    rng: np.random.Generator = None) -> tuple:
+    """
+    Function for estimating probability of player A going bankrupt with importance sampling (exponential tilting),
+    which stays accurate when the probability is very small or very close to 1. Games are played with p and q swapped,
+    which makes the rare result common, and each game is weighted with likelihood ratio between original and swapped
+    game. For a game lost by player A the ratio is always (q / p)^a, for a game won by player A it is (p / q)^b, so the
+    estimate is unbiased and needs only a few thousand games whatever the probability.
+    :param iterations: Number of games
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability of winning by player A in single game turn
+    :param q: Probability of winning by player B in single game turn
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Tuple (probability, standard_error) with probability of player A going bankrupt and standard error of it
+    """
+    # games with known result
+    if a_capital == 0 or p == 0:
+        return 1.0, 0.0
+    if b_capital == 0 or q == 0:
+        return 0.0, 0.0
+
+    # main function logic
+    tilted_loses = experimental_probability_vectorized(iterations=iterations,
+                                                       a_capital=a_capital,
+                                                       b_capital=b_capital,
+                                                       p=q,
+                                                       q=p,
+                                                       rng=rng)
+    tilted_error = math.sqrt(tilted_loses * (1 - tilted_loses) / iterations)
+    if p >= q:  # bankruptcy of player A is the rare result
+        likelihood_ratio = math.exp(a_capital * math.log(q / p))
+        return likelihood_ratio * tilted_loses, likelihood_ratio * tilted_error
+    likelihood_ratio = math.exp(b_capital * math.log(p / q))  # win of player A is the rare result
+    return 1 - likelihood_ratio * (1 - tilted_loses), likelihood_ratio * tilted_error
+
+
+def wilson_interval(successes: int, trials: int, z: float = 1.96) -> tuple:
+    """
+    Function for calculating Wilson score confidence interval of a probability.
+    :param successes: Number of observed events
+    :param trials: Number of trials
+    :param z: Quantile of standard normal distribution for requested confidence (1.96 for 95%)
+    :return: Tuple (lower, upper) with interval bounds
+    """
+    # initial variables
+    estimate: float = successes / trials
+    z_squared: float = z * z
+
+    # main function logic
+    center = (estimate + z_squared / (2 * trials)) / (1 + z_squared / trials)
+    half_width = z * math.sqrt(estimate * (1 - estimate) / trials + z_squared / (4 * trials * trials)) / (
+            1 + z_squared / trials)
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def experimental_probability_sequential(a_capital: int, b_capital: int, p: float, q: float, tolerance: float = 0.01,
+                                        batch_size: int = 1000, max_iterations: int = 10 ** 6, z: float = 1.96,
+                                        rng: np.random.Generator = None) -> tuple:
+    """
+    Function for calculating experimental probability for specified p, q, player A capital, player B capital with
+    sequential early stopping. Games are played in batches with lockstep NumPy engine until width of Wilson confidence
+    interval of the estimate is smaller than tolerance (or max_iterations games are played). Games with known result
+    (p = 0, q = 0 or capital equal to 0) are not played at all.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability of winning by player A in single game turn
+    :param q: Probability of winning by player B in single game turn
+    :param tolerance: Requested width of confidence interval
+    :param batch_size: Number of games played between consecutive interval checks
+    :param max_iterations: Maximum number of games played
+    :param z: Quantile of standard normal distribution for requested confidence (1.96 for 95%)
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Tuple (probability, games) with probability of player A going bankrupt and number of games played
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    a_loses: int = 0
+    games: int = 0
+
+    # games with known result
+    if a_capital == 0 or p == 0:
+        return 1.0, 0
+    if b_capital == 0 or q == 0:
+        return 0.0, 0
+
+    # main function logic
+    while games < max_iterations:
+        current_batch = min(batch_size, max_iterations - games)
+        a_loses += count_a_loses_vectorized(iterations=current_batch,
+                                            a_capital=a_capital,
+                                            b_capital=b_capital,
+                                            p=p,
+                                            q=q,
+                                            rng=rng)
+        games += current_batch
+        lower, upper = wilson_interval(successes=a_loses, trials=games, z=z)
+        if upper - lower < tolerance:
+            break
+    return a_loses / games, games
+
+
 def generate_theory_list(p: float, q: float) -> list:
     """
     Function for generating list with theoretical win probability values at each for given capital values.
@@ -66,56 +254,184 @@ def generate_theory_list(p: float, q: float) -> list:
     :return: List of theoretical win probability values
     """
     # initial variables
+    a_capitals = np.arange(0, 101, 10)
+
+    # main function logic
+    return theory_probability_vectorized(p=p / (p + q), a_capital=a_capitals, b_capital=100 - a_capitals).tolist()
+
+
+def generate_experimental_list(iterations: int, p: float, q: float, vectorized: bool = False) -> list:
+    """
+    Function for generating list with experimental win probability values at each for given capital values.
+    :param iterations: Number of games played
+    :param p: Probability of player A win in single game turn
+    :param q: Probability of player B win in single game turn
+    :param vectorized: If True, games are played with lockstep NumPy engine instead of one by one
+    :return: List of experimental win probability values
+    """
+    # initial variables
     lst: list = []
+    engine = experimental_probability_vectorized if vectorized else experimental_probability
 
     # main function logic
     for x in range(0, 101, 10):
         a_capital = x
         b_capital = 100 - x
-        lst.append(theory_probability(p=p, q=q, a_capital=a_capital, b_capital=b_capital))
+        print(f"Current: A = {a_capital}, B = {b_capital}")
+        lst.append(engine(iterations=iterations,
+                          a_capital=a_capital,
+                          b_capital=b_capital,
+                          p=p,
+                          q=q))
     return lst
 
 
-def generate_experimental_list(iterations: int, p: float, q: float) -> list:
+def generate_experimental_list_sequential(max_iterations: int, p: float, q: float, tolerance: float = 0.01,
+                                          seed: int = None) -> tuple:
     """
-    Function for generating list with experimental win probability values at each for given capital values.
+    Function for generating list with experimental win probability values at each for given capital values, with
+    every capital split played only until its confidence interval is narrower than tolerance.
+    :param max_iterations: Maximum number of games played at each capital split
+    :param p: Probability of player A win in single game turn
+    :param q: Probability of player B win in single game turn
+    :param tolerance: Requested width of confidence interval
+    :param seed: Seed of random generator shared by the whole sweep (unseeded if not given)
+    :return: Tuple (values, games) containing list of experimental win probability values and list of games played at
+    each capital split
+    """
+    # initial variables
+    lst: list = []
+    games_list: list = []
+    rng = np.random.default_rng(seed)
+
+    # main function logic
+    for x in range(0, 101, 10):
+        a_capital = x
+        b_capital = 100 - x
+        probability, games = experimental_probability_sequential(a_capital=a_capital,
+                                                                 b_capital=b_capital,
+                                                                 p=p,
+                                                                 q=q,
+                                                                 tolerance=tolerance,
+                                                                 max_iterations=max_iterations,
+                                                                 rng=rng)
+        print(f"Current: A = {a_capital}, B = {b_capital}, games played = {games}")
+        lst.append(probability)
+        games_list.append(games)
+    return lst, games_list
+
+
+def generate_experimental_list_tilted(iterations: int, p: float, q: float) -> tuple:
+    """
+    Function for generating list with experimental win probability values at each for given capital values, estimated
+    with importance sampling (see experimental_probability_tilted).
     :param iterations: Number of games played
     :param p: Probability of player A win in single game turn
     :param q: Probability of player B win in single game turn
-    :return: List of experimental win probability values
+    :return: Tuple (values, errors) containing list of experimental win probability values and list of their standard
+    errors
     """
     # initial variables
     lst: list = []
+    errors: list = []
 
     # main function logic
     for x in range(0, 101, 10):
         a_capital = x
         b_capital = 100 - x
         print(f"Current: A = {a_capital}, B = {b_capital}")
-        lst.append(experimental_probability(iterations=iterations,
-                                            a_capital=a_capital,
-                                            b_capital=b_capital,
-                                            p=p,
-                                            q=q))
+        probability, error = experimental_probability_tilted(iterations=iterations,
+                                                             a_capital=a_capital,
+                                                             b_capital=b_capital,
+                                                             p=p,
+                                                             q=q)
+        lst.append(probability)
+        errors.append(error)
+    return lst, errors
+
+
+def _experimental_point(seed_sequence: np.random.SeedSequence, **kwargs) -> float:
+    """
+    Helper function for calculating experimental probability of single grid point in worker process.
+    :param seed_sequence: Seed sequence from which grid point's own random generator is created
+    :param kwargs: Keyword arguments passed to experimental_probability_vectorized
+    :return: Probability to win by player A
+    """
+    return experimental_probability_vectorized(rng=np.random.default_rng(seed_sequence), **kwargs)
+
+
+def generate_experimental_list_parallel(iterations: int, p: float, q: float, workers: int = None,
+                                        seed: int = None) -> list:
+    """
+    Function for generating list with experimental win probability values at each for given capital values, with
+    capital splits spread across a process pool. Every split gets its own random stream spawned from seed, so results
+    are identical whatever the number of workers. Most even splits (the longest games) are submitted first and each
+    worker takes next split as soon as it is free, which keeps uneven work balanced.
+    :param iterations: Number of games played
+    :param p: Probability of player A win in single game turn
+    :param q: Probability of player B win in single game turn
+    :param workers: Number of worker processes (number of CPUs if not given)
+    :param seed: Seed of the whole sweep (fresh entropy if not given)
+    :return: List of experimental win probability values
+    """
+    # initial variables
+    a_values: list = [x for x in range(0, 101, 10)]
+    seed_sequences: list = np.random.SeedSequence(seed).spawn(len(a_values))  # one random stream per capital split
+    lst: list = [0.0 for _ in a_values]
+
+    # main function logic
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for idx in sorted(range(len(a_values)), key=lambda i: -a_values[i] * (100 - a_values[i])):
+            futures[executor.submit(_experimental_point, seed_sequences[idx],
+                                    iterations=iterations,
+                                    a_capital=a_values[idx],
+                                    b_capital=100 - a_values[idx],
+                                    p=p,
+                                    q=q)] = idx
+        for future in as_completed(futures):
+            idx = futures[future]
+            lst[idx] = future.result()
+            print(f"Done: A = {a_values[idx]}, B = {100 - a_values[idx]}")
     return lst
 
 
-def show_graph(iterations: int, p: float, q: float) -> None:
+def show_graph(iterations: int, p: float, q: float, vectorized: bool = False, workers: int = None,
+               seed: int = None, tolerance: float = None) -> None:
     """
     Function for generating scatter/plot chart with experimental and theoretical values for player A winning
     probability depending on player A and player B capitals.
     :param iterations: Number of games played
     :param p: Probability of player A win in single game turn
     :param q: Probability of player B win in single game turn
+    :param vectorized: If True, games are played with lockstep NumPy engine instead of one by one
+    :param workers: If given, capital splits are spread across process pool with this number of workers
+    :param seed: Seed of the parallel or sequential sweep, used only together with workers or tolerance
+    :param tolerance: If given, each capital split is played only until its confidence interval is narrower than this
+    value (iterations is then the maximum number of games)
     :return: None
     """
     # initial variables and generating data
     theory_list: list = generate_theory_list(p=p,
                                              q=q)
     print(f"Theoretical list done")
-    experimental_list: list = generate_experimental_list(iterations=iterations,
-                                                         p=p,
-                                                         q=q)
+    if workers:
+        experimental_list: list = generate_experimental_list_parallel(iterations=iterations,
+                                                                      p=p,
+                                                                      q=q,
+                                                                      workers=workers,
+                                                                      seed=seed)
+    elif tolerance:
+        experimental_list, _ = generate_experimental_list_sequential(max_iterations=iterations,
+                                                                     p=p,
+                                                                     q=q,
+                                                                     tolerance=tolerance,
+                                                                     seed=seed)
+    else:
+        experimental_list: list = generate_experimental_list(iterations=iterations,
+                                                             p=p,
+                                                             q=q,
+                                                             vectorized=vectorized)
     print(f"Experimental list done")
     a_list: list = [x for x in range(0, 101, 10)]
 
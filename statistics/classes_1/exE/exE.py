@@ -2,6 +2,7 @@
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 
 
@@ -32,27 +33,135 @@ def play_game(a_capital: int, b_capital: int, p: float) -> int:
     return game_turn
 
 
-def generate_game_grap(games_number_per_probability: int, a_capital: int, b_capital: int) -> None:
+def play_game_chunked(a_capital: int, b_capital: int, p: float, rng: np.random.Generator = None) -> int:
+    """
+    Function for performing a single game.
+    Walk of player A's capital is advanced by whole blocks of turns, with number of won turns in block drawn from
+    single binomial distribution. Block which could have touched 0 or capital sum is split in halves, with wins in the
+    first half drawn from hypergeometric distribution (bridge of the block), until remaining parts are safe or single
+    turns - so game length and winner have exactly the same distribution as in play_game.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round (turn) by player A
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Number of turns in the played game
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    capital_sum: int = a_capital + b_capital
+    game_turn: int = 0
+
+    # main game
+    while 0 < a_capital < capital_sum:
+        distance = min(a_capital, capital_sum - a_capital)
+        block = distance * distance  # number of turns after which capital typically moves by distance
+        segments: list = [(block, int(rng.binomial(block, p)))]  # stack of (turns, wins), next segment on top
+        while segments:
+            turns, wins = segments.pop()
+            if a_capital - (turns - wins) > 0 and a_capital + wins < capital_sum:  # segment can't touch the end
+                a_capital += 2 * wins - turns
+                game_turn += turns
+            elif turns == 1:
+                a_capital += 2 * wins - 1
+                game_turn += 1
+                if a_capital == 0 or a_capital == capital_sum:
+                    break
+            else:
+                half = turns // 2
+                first_wins = int(rng.hypergeometric(wins, turns - wins, half))
+                segments.append((turns - half, wins - first_wins))
+                segments.append((half, first_wins))
+    return game_turn
+
+
+def game_length_distribution(a_capital: int, b_capital: int, p: float, tolerance: float = 1e-12) -> np.ndarray:
+    """
+    Function for calculating exact probability distribution of the game length. Probability mass of player A's
+    capital is moved one turn at a time over transient states (1 ... capital sum - 1), and the mass falling into 0 or
+    capital sum at given turn is the probability of the game ending at that turn.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round (turn) by player A
+    :param tolerance: Calculations stop when probability of the game still going on drops below this value
+    :return: Array where element with index t is probability that the game lasts exactly t turns
+    """
+    # initial variables
+    capital_sum: int = a_capital + b_capital
+    states = np.zeros(capital_sum + 1)  # probability of player A having given capital while game still goes on
+    states[a_capital] = 1.0
+    length_probabilities: list = [0.0]
+
+    # game which is already finished before the first turn
+    if a_capital == 0 or b_capital == 0:
+        return np.array([1.0])
+
+    # main function logic
+    while states.sum() >= tolerance:
+        next_states = np.zeros_like(states)
+        next_states[1:] += p * states[:-1]
+        next_states[:-1] += (1 - p) * states[1:]
+        length_probabilities.append(next_states[0] + next_states[-1])
+        next_states[0] = next_states[-1] = 0.0
+        states = next_states
+    return np.array(length_probabilities)
+
+
+def maximum_length_statistics(length_probabilities: np.ndarray, games_number: int,
+                              quantiles: tuple = (0.5, 0.9, 0.99)) -> tuple:
+    """
+    Function for calculating distribution of the maximum game length over given number of independent games,
+    from the CDF of single game length raised to the power of games number.
+    :param length_probabilities: Exact distribution of single game length (see game_length_distribution)
+    :param games_number: Number of games played
+    :param quantiles: Quantiles of the maximum game length to calculate
+    :return: Tuple (expected, quantiles, probabilities) containing expected maximum game length, list of requested
+    quantiles and array with distribution of the maximum game length
+    """
+    # initial variables
+    max_cdf = np.minimum(np.cumsum(length_probabilities), 1.0) ** games_number
+
+    # main function logic
+    expected: float = float(np.sum(1.0 - max_cdf))  # E[L] = sum of P(L > t) over all turns t
+    quantile_values: list = [int(min(np.searchsorted(max_cdf, quantile), len(max_cdf) - 1)) for quantile in quantiles]
+    return expected, quantile_values, np.diff(max_cdf, prepend=0.0)
+
+
+def generate_game_grap(games_number_per_probability: int, a_capital: int, b_capital: int,
+                       exact: bool = False, chunked: bool = False) -> None:
     """
     Function for performing multiple games and generating adequate graph.
     :param games_number_per_probability: Number of games to perform at each probability
     :param a_capital: Capital of player A
     :param b_capital: Capital of player B
+    :param exact: If True, expected Lmax is calculated from exact game length distribution instead of playing games
+    :param chunked: If True, games are played by blocks of turns with play_game_chunked
     :return: None
     """
     # initial variables
     probability_for_turns: list = []
     most_turns: list = []
 
+    engine = play_game_chunked if chunked else play_game
+
     # main program logic
     for current_prob in range(0, 101, 10):
         a_win_probability = current_prob / 100
         print(f"Current p: {a_win_probability}")
         current_highest = 0
-        for game in range(games_number_per_probability):
-            game_length = play_game(a_capital=a_capital, b_capital=b_capital, p=a_win_probability)
-            if game_length > current_highest:
-                current_highest = game_length
+        if exact:
+            length_probabilities = game_length_distribution(a_capital=a_capital,
+                                                            b_capital=b_capital,
+                                                            p=a_win_probability,
+                                                            tolerance=1e-9 / games_number_per_probability)
+            expected, quantile_values, _ = maximum_length_statistics(length_probabilities=length_probabilities,
+                                                                     games_number=games_number_per_probability)
+            print(f"Expected Lmax: {expected:.1f}, Lmax quantiles (50%, 90%, 99%): {quantile_values}")
+            current_highest = round(expected)
+        else:
+            for game in range(games_number_per_probability):
+                game_length = engine(a_capital=a_capital, b_capital=b_capital, p=a_win_probability)
+                if game_length > current_highest:
+                    current_highest = game_length
         probability_for_turns.append(a_win_probability)
         most_turns.append(current_highest)
 
@@ -3,6 +3,7 @@
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 
 
@@ -32,6 +33,44 @@ def play_game(a_capital: int, b_capital: int, p: float) -> bool:
             return True
 
 
+def play_game_chunked(a_capital: int, b_capital: int, p: float, rng: np.random.Generator = None) -> bool:
+    """
+    Function for performing single game. Return player A value (True/False).
+    Walk of player A's capital is advanced by whole blocks of turns, with number of won turns in block drawn from
+    single binomial distribution. Block which could have touched 0 or capital sum is split in halves, with wins in the
+    first half drawn from hypergeometric distribution (bridge of the block), until remaining parts are safe or single
+    turns - so game length and winner have exactly the same distribution as in play_game.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round by player A
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Return player A value (True/False)
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    capital_sum: int = a_capital + b_capital
+
+    # main game
+    while 0 < a_capital < capital_sum:
+        distance = min(a_capital, capital_sum - a_capital)
+        block = distance * distance  # number of turns after which capital typically moves by distance
+        segments: list = [(block, int(rng.binomial(block, p)))]  # stack of (turns, wins), next segment on top
+        while segments:
+            turns, wins = segments.pop()
+            if a_capital - (turns - wins) > 0 and a_capital + wins < capital_sum:  # segment can't touch the end
+                a_capital += 2 * wins - turns
+            elif turns == 1:
+                a_capital += 2 * wins - 1
+                if a_capital == 0 or a_capital == capital_sum:
+                    break
+            else:
+                half = turns // 2
+                first_wins = int(rng.hypergeometric(wins, turns - wins, half))
+                segments.append((turns - half, wins - first_wins))
+                segments.append((half, first_wins))
+    return a_capital == capital_sum
+
+
 def generate_color() -> tuple:
     """Helper function for generating random color.
      :return: Tuple (r, g, b) signifying color"""
@@ -41,28 +80,117 @@ def generate_color() -> tuple:
     return r, g, b
 
 
-def generate_game_grap(num_of_games: int, a_capital: int, b_capital: int) -> None:
+def play_games_lockstep(num_of_games: int, a_capital: int, b_capital: int, probabilities: list,
+                        block_size: int = 64, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Function for performing all games for all probabilities at once. Games are played together in lockstep as NumPy
+    arrays - every round advances each unfinished game by up to block_size turns, finished games are masked out and
+    only the remaining ones are carried to the next round.
+    :param num_of_games: Number of games to perform at each probability
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param probabilities: Probabilities to win single round by player A
+    :param block_size: Maximum number of turns performed for every unfinished game in single round
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Boolean array with one row per probability, where element with index n is result of game n + 1 for
+    player A (True - won)
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    capital_sum: int = a_capital + b_capital
+    win_chances = np.repeat(np.asarray(probabilities, dtype=float), num_of_games)  # chance in every game
+    capitals = np.full(win_chances.size, a_capital, dtype=np.int32)  # player A capital in every unfinished game
+    unfinished = np.arange(win_chances.size)  # indexes of unfinished games
+    wins = np.zeros(win_chances.size, dtype=bool)
+
+    # games which are already finished before the first turn
+    if a_capital == 0 or b_capital == 0:
+        wins[:] = b_capital == 0
+        return wins.reshape(len(probabilities), num_of_games)
+
+    # main function logic
+    while unfinished.size:
+        turns = max(1, min(block_size, 2 ** 24 // unfinished.size))  # keep single round under ~16M cells
+        steps = np.where(rng.random((turns, unfinished.size)) < win_chances[unfinished], 1, -1).astype(np.int32)
+        paths = capitals + np.cumsum(steps, axis=0, dtype=np.int32)  # capital after each turn of the round
+        hits = (paths == 0) | (paths == capital_sum)
+        finished = hits.any(axis=0)
+        first_hit = hits.argmax(axis=0)[finished]  # turn at which finished game hit 0 or capital sum
+        wins[unfinished[finished]] = paths[first_hit, np.flatnonzero(finished)] == capital_sum
+        capitals = paths[-1, ~finished]
+        unfinished = unfinished[~finished]
+    return wins.reshape(len(probabilities), num_of_games)
+
+
+def generate_wins_trajectories(num_of_games: int, a_capital: int, b_capital: int, probabilities: list,
+                               rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Function for calculating number of wins trajectories for all probabilities at once. All games are played with
+    play_games_lockstep and trajectories are built with cumulative sum of their results.
+    :param num_of_games: Number of games to perform at each probability
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param probabilities: Probabilities to win single round by player A
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: Array with one row per probability, where element with index n is number of wins after n games
+    """
+    # initial variables
+    trajectories = np.zeros((len(probabilities), num_of_games + 1), dtype=np.int64)
+
+    # main function logic
+    np.cumsum(play_games_lockstep(num_of_games=num_of_games,
+                                  a_capital=a_capital,
+                                  b_capital=b_capital,
+                                  probabilities=probabilities,
+                                  rng=rng), axis=1, out=trajectories[:, 1:])
+    return trajectories
+
+
+def decimate_trajectory(trajectory: np.ndarray, max_points: int = 2000) -> tuple:
+    """
+    Function for reducing trajectory to bounded number of evenly spaced points (first and last one always kept), so
+    it can be drawn in constant time.
+    :param trajectory: Values of trajectory, where index is the game number
+    :param max_points: Maximum number of points left
+    :return: Tuple (x_values, y_values) with kept game numbers and their values
+    """
+    x_values = np.unique(np.linspace(0, len(trajectory) - 1, min(max_points, len(trajectory))).astype(np.int64))
+    return x_values, trajectory[x_values]
+
+
+def generate_game_grap(num_of_games: int, a_capital: int, b_capital: int, chunked: bool = False,
+                       batched: bool = False) -> None:
     """
     Function for performing multiple games and generating adequate graph.
     :param num_of_games: Number of games to perform at each probability
     :param a_capital: Capital of player A
     :param b_capital: Capital of player B
+    :param chunked: If True, games are played by blocks of turns with play_game_chunked
+    :param batched: If True, all games are played at once in lockstep and trajectories are decimated for drawing
     :return: None
     """
     # initial variables
     probabilities: list = [0.3, 0.5, 0.7]
     results_data: list = []
+    engine = play_game_chunked if chunked else play_game
 
     # main program logic
-    for probability in probabilities:
-        current_game_results = [(0, 0)]
-        current_game_wins = 0
-        for game in range(1, num_of_games + 1):
-            result = play_game(a_capital=a_capital, b_capital=b_capital, p=probability)
-            if result:
-                current_game_wins += 1
-            current_game_results.append((game, current_game_wins))
-        results_data.append(current_game_results)
+    if batched:
+        trajectories = generate_wins_trajectories(num_of_games=num_of_games,
+                                                  a_capital=a_capital,
+                                                  b_capital=b_capital,
+                                                  probabilities=probabilities)
+        results_data = [list(zip(*decimate_trajectory(trajectory))) for trajectory in trajectories]
+    else:
+        for probability in probabilities:
+            current_game_results = [(0, 0)]
+            current_game_wins = 0
+            for game in range(1, num_of_games + 1):
+                result = engine(a_capital=a_capital, b_capital=b_capital, p=probability)
+                if result:
+                    current_game_wins += 1
+                current_game_results.append((game, current_game_wins))
+            results_data.append(current_game_results)
 
     # draw graph
     fig, ax = plt.subplots()
@@ -73,9 +201,10 @@ def generate_game_grap(num_of_games: int, a_capital: int, b_capital: int) -> Non
         y_values = [pair[1] for pair in plot]
         ax.step(x_values, y_values, color=color, zorder=idx, label=f'p={prob}')
     ax.grid(zorder=1)
-    ticks_range = range(num_of_games + 1)
-    plt.xticks(ticks_range)
-    plt.yticks(ticks_range)
+    if num_of_games <= 50:  # one tick per game only while they are readable
+        ticks_range = range(num_of_games + 1)
+        plt.xticks(ticks_range)
+        plt.yticks(ticks_range)
     plt.ylabel(f"Number of wins")
     plt.xlabel(f"Current game number")
     plt.title(f"Player A's winning trajectory for different probabilities\n"
@@ -3,7 +3,9 @@
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
 import matplotlib.pyplot as plt
+import numpy as np
 import random
+from array import array
 
 
 def play_game(a_capital: int, b_capital: int, p: float) -> list:
@@ -37,6 +39,117 @@ def play_game(a_capital: int, b_capital: int, p: float) -> list:
     return player_a_capital_turns
 
 
+def play_game_chunked(a_capital: int, b_capital: int, p: float, rng: np.random.Generator = None) -> list:
+    """
+    Function for performing single game.
+    Walk of player A's capital is advanced by whole blocks of turns, with number of won turns in block drawn from
+    single binomial distribution. Block which could have touched 0 or capital sum is split in halves, with wins in the
+    first half drawn from hypergeometric distribution (bridge of the block), until remaining parts are safe or single
+    turns - so game length and winner have exactly the same distribution as in play_game.
+    Capital is recorded only at the end of each safe block, so the trajectory is exact but sparser than in play_game.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round by player A
+    :param rng: NumPy random generator used for drawing turns (new unseeded generator if not given)
+    :return: List of (turn, capital) tuples containing player's A capital at the end of each block.
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+    capital_sum: int = a_capital + b_capital
+    game_turn: int = 0
+    player_a_capital_turns: list = [(0, a_capital)]
+
+    # main game
+    while 0 < a_capital < capital_sum:
+        distance = min(a_capital, capital_sum - a_capital)
+        block = distance * distance  # number of turns after which capital typically moves by distance
+        segments: list = [(block, int(rng.binomial(block, p)))]  # stack of (turns, wins), next segment on top
+        while segments:
+            turns, wins = segments.pop()
+            if a_capital - (turns - wins) > 0 and a_capital + wins < capital_sum:  # segment can't touch the end
+                a_capital += 2 * wins - turns
+                game_turn += turns
+                player_a_capital_turns.append((game_turn, a_capital))
+            elif turns == 1:
+                a_capital += 2 * wins - 1
+                game_turn += 1
+                player_a_capital_turns.append((game_turn, a_capital))
+                if a_capital == 0 or a_capital == capital_sum:
+                    break
+            else:
+                half = turns // 2
+                first_wins = int(rng.hypergeometric(wins, turns - wins, half))
+                segments.append((turns - half, wins - first_wins))
+                segments.append((half, first_wins))
+    return player_a_capital_turns
+
+
+def iterate_game(a_capital: int, b_capital: int, p: float):
+    """
+    Generator performing single game turn by turn, without keeping the trajectory in memory. Yields exactly the same
+    values as play_game puts into its list (for the same random state).
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round by player A
+    :return: Generator of (turn, capital) tuples containing player's A capital each turn.
+    """
+    # initial variables
+    population: list = ['A', 'B']
+    weights: list = [p, 1 - p]
+    turn: int = 0
+    yield turn, a_capital
+
+    # main game
+    while True:
+        if random.choices(population, weights)[0] == 'A':
+            a_capital += 1
+            b_capital -= 1
+        else:
+            a_capital -= 1
+            b_capital += 1
+        turn += 1
+        yield turn, a_capital
+        if a_capital == 0 or b_capital == 0:
+            break
+
+
+def play_game_array(a_capital: int, b_capital: int, p: float) -> array:
+    """
+    Function for performing single game, with player A's capital stored in typed array (4 bytes per turn).
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round by player A
+    :return: Array with player's A capital, where index of element is the turn number
+    """
+    return array('i', (capital for _, capital in iterate_game(a_capital=a_capital, b_capital=b_capital, p=p)))
+
+
+def play_game_turning_points(a_capital: int, b_capital: int, p: float) -> tuple:
+    """
+    Function for performing single game, with trajectory stored only as turning points (first turn, last turn and
+    turns after which capital changes direction). Straight lines between turning points give back the whole trajectory.
+    :param a_capital: Capital of player A
+    :param b_capital: Capital of player B
+    :param p: Probability to win single round by player A
+    :return: Tuple (turns, capitals) of typed arrays with turning points of player's A capital
+    """
+    # initial variables
+    turns: array = array('q')
+    capitals: array = array('i')
+    last_turn, last_capital, last_direction = 0, a_capital, 0
+
+    # main function logic
+    for turn, capital in iterate_game(a_capital=a_capital, b_capital=b_capital, p=p):
+        direction = capital - last_capital
+        if direction != last_direction:
+            turns.append(last_turn)
+            capitals.append(last_capital)
+        last_turn, last_capital, last_direction = turn, capital, direction
+    turns.append(last_turn)
+    capitals.append(last_capital)
+    return turns, capitals
+
+
 def generate_color() -> tuple:
     """Helper function for generating random color.
      :return: Tuple (r, g, b) signifying color"""
@@ -46,29 +159,52 @@ def generate_color() -> tuple:
     return r, g, b
 
 
-def generate_game_grap(a_capital: int, b_capital: int) -> None:
+def generate_game_grap(a_capital: int, b_capital: int, chunked: bool = False, storage: str = 'list') -> None:
     """
     Function for performing multiple games and generating adequate graph.
     :param a_capital: Capital of player A
     :param b_capital: Capital of player B
+    :param chunked: If True, games are played by blocks of turns with play_game_chunked (capital is drawn only at
+    block ends, only with 'list' storage)
+    :param storage: How trajectory is stored: 'list' of (turn, capital) tuples, 'array' of capitals or 'turning' points
     :return: None
     """
     # initial variables
+    if storage not in ('list', 'array', 'turning'):
+        raise ValueError(f"Unknown storage: {storage}")
+    if chunked and storage != 'list':
+        raise ValueError("Chunked games are stored only as 'list'")
     probabilities: list = [0.25, 0.5, 0.75]
     results_data: list = []
+    engine = play_game_chunked if chunked else play_game
 
     # main program logic
     for probability in probabilities:
-        result = play_game(a_capital=a_capital, b_capital=b_capital, p=probability)
+        if storage == 'array':
+            result = play_game_array(a_capital=a_capital, b_capital=b_capital, p=probability)
+        elif storage == 'turning':
+            result = play_game_turning_points(a_capital=a_capital, b_capital=b_capital, p=probability)
+        else:
+            result = engine(a_capital=a_capital, b_capital=b_capital, p=probability)
         results_data.append(result)
-    print(results_data)
+    if storage == 'list':
+        print(results_data)
     # draw graph
     fig, ax = plt.subplots()
     for current_plot_data, current_p in zip(results_data, probabilities):
         color = generate_color()
-        x_values = [pair[0] for pair in current_plot_data]
-        y_values = [pair[1] for pair in current_plot_data]
-        ax.step(x_values, y_values, color=color, zorder=3, label=f'p={current_p}')
+        if storage == 'array':
+            ax.step(range(len(current_plot_data)), current_plot_data, color=color, zorder=3, label=f'p={current_p}')
+        elif storage == 'turning':
+            ax.plot(*current_plot_data, color=color, zorder=3, label=f'p={current_p}')
+        elif chunked:  # capital known only at block ends - points are joined with lines, not steps
+            x_values = [pair[0] for pair in current_plot_data]
+            y_values = [pair[1] for pair in current_plot_data]
+            ax.plot(x_values, y_values, color=color, zorder=3, label=f'p={current_p} (sampled at block ends)')
+        else:
+            x_values = [pair[0] for pair in current_plot_data]
+            y_values = [pair[1] for pair in current_plot_data]
+            ax.step(x_values, y_values, color=color, zorder=3, label=f'p={current_p}')
     ax.grid(zorder=1)
     ax.locator_params(axis='x', nbins=22)
     plt.yticks(range(0, a_capital + b_capital + 1, round((a_capital + b_capital) / 20)))
@@ -6,7 +6,9 @@
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
 
+from typing import NamedTuple
 import matplotlib.pyplot as plt
+import numpy as np
 
 
 def multiply_matrix_by_matrix(first_matrix: list, second_matrix: list) -> list:
@@ -36,6 +38,195 @@ def highest(matrix: list) -> float:
     return max(item for sublist in matrix for item in sublist)
 
 
+class SparseMatrix(NamedTuple):
+    """
+    Transition matrix in compressed sparse row (CSR) format - memory proportional to number of non-zero elements.
+    Non-zero elements of row i are data[indptr[i]:indptr[i + 1]], placed in columns indices[indptr[i]:indptr[i + 1]].
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    states: int
+
+
+def sparse_from_triplets(rows, cols, values, states: int) -> SparseMatrix:
+    """
+    Function for building sparse matrix from (row, column, value) triplets. Repeated positions are summed.
+    :param rows: Row index of each non-zero element
+    :param cols: Column index of each non-zero element
+    :param values: Value of each non-zero element
+    :param states: Number of states (matrix is states x states)
+    :return: Sparse matrix
+    """
+    # initial variables
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+
+    # main function logic
+    order = np.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])  # first occurrence of every position
+    starts = np.flatnonzero(first)
+    values = np.add.reduceat(values, starts) if len(starts) else values
+    rows, cols = rows[starts], cols[starts]
+    indptr = np.zeros(states + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=states), out=indptr[1:])
+    return SparseMatrix(indptr=indptr, indices=cols, data=values, states=states)
+
+
+def sparse_from_dense(matrix) -> SparseMatrix:
+    """
+    Function for converting dense matrix (double nested list or NumPy array) to sparse matrix.
+    :param matrix: Dense matrix
+    :return: Sparse matrix
+    """
+    rows, cols = np.nonzero(np.asarray(matrix, dtype=float))
+    return sparse_from_triplets(rows, cols, np.asarray(matrix, dtype=float)[rows, cols], len(matrix))
+
+
+def vector_times_sparse(vector: np.ndarray, matrix: SparseMatrix) -> np.ndarray:
+    """
+    Function for multiplying row vector by sparse matrix (vector * P), in O(number of non-zero elements).
+    :param vector: Row vector (e.g. distribution over states)
+    :param matrix: Sparse matrix
+    :return: Result row vector
+    """
+    weights = matrix.data * np.repeat(vector, np.diff(matrix.indptr))
+    return np.bincount(matrix.indices, weights=weights, minlength=matrix.states)
+
+
+def multiply_matrix_by_matrix_numpy(first_matrix, second_matrix) -> np.ndarray:
+    """
+    Function for performing matrix multiplication with NumPy (BLAS).
+    :param first_matrix: First matrix for multiply represented as double nested list or NumPy array
+    :param second_matrix: Second matrix for multiply represented as double nested list or NumPy array
+    :return: Result matrix represented as NumPy array
+    """
+    return np.asarray(first_matrix, dtype=float) @ np.asarray(second_matrix, dtype=float)
+
+
+multiplication_backends: dict = {'python': multiply_matrix_by_matrix,
+                                 'numpy': multiply_matrix_by_matrix_numpy}  # available matrix multiplication functions
+
+
+def highest_difference(first_matrix, second_matrix) -> float:
+    """
+    Function for finding highest absolute difference between corresponding elements of two matrices.
+    :param first_matrix: First matrix represented as double nested list or NumPy array
+    :param second_matrix: Second matrix represented as double nested list or NumPy array
+    :return: Highest absolute difference
+    """
+    if isinstance(first_matrix, np.ndarray) or isinstance(second_matrix, np.ndarray):
+        return float(np.max(np.abs(np.asarray(first_matrix) - np.asarray(second_matrix))))
+    return max(abs(x - y) for first_row, second_row in zip(first_matrix, second_matrix)
+               for x, y in zip(first_row, second_row))
+
+
+def matrix_power(base_matrix, power: int, backend: str = 'numpy'):
+    """
+    Function for calculating matrix raised to given power by repeated squaring (O(log power) multiplications).
+    :param base_matrix: Base matrix represented as double nested list or NumPy array
+    :param power: Power to raise matrix to (at least 1)
+    :param backend: Name of multiplication backend from multiplication_backends
+    :return: base_matrix ^ power in type returned by the backend
+    """
+    # initial variables
+    if power < 1:
+        raise ValueError(f"Power has to be at least 1, not {power}")
+    multiply = multiplication_backends[backend]
+    result = None
+    square = base_matrix
+
+    # main function logic
+    while power:
+        if power % 2:
+            result = square if result is None else multiply(result, square)
+        power //= 2
+        if power:
+            square = multiply(square, square)
+    return result
+
+
+def calculation_handler_squaring(base_matrix, convergence_criterion: float, max_squarings: int = 64,
+                                 backend: str = 'numpy') -> tuple:
+    """
+    Function for finding limit matrix by repeated squaring: P, P^2, P^4, P^8, ... until highest difference between
+    consecutive checkpoints is smaller than convergence criterion. Each squaring is done with matrix_power.
+    :param base_matrix: Base Markov matrix represented as double nested list or NumPy array
+    :param convergence_criterion: Assumed convergence criterion after which calculations stop
+    :param max_squarings: Maximum number of squarings performed
+    :param backend: Name of multiplication backend from multiplication_backends
+    :return: Tuple (result, power), where result is base matrix raised to power
+    """
+    # initial variables
+    next_matrix = base_matrix
+    power: int = 1
+
+    # main function logic
+    for _ in range(max_squarings):
+        prev_matrix = next_matrix
+        next_matrix = matrix_power(prev_matrix, 2, backend)
+        power *= 2
+        if highest_difference(prev_matrix, next_matrix) < convergence_criterion:
+            break
+    return next_matrix, power
+
+
+def stationary_distribution(base_matrix, method: str = 'solve', tolerance: float = 1e-12,
+                            max_iterations: int = 100000, trace: bool = False) -> tuple:
+    """
+    Function for finding stationary distribution pi (pi * P = pi, sum of pi = 1) of Markov matrix directly.
+    Method 'solve' solves linear system (P^T - I) * pi = 0 with one equation replaced by normalization, method 'power'
+    multiplies distribution vector by matrix (O(n^2) per iteration instead of O(n^3)) until its highest change is
+    smaller than tolerance. Sparse matrix works only with 'power' method, with O(number of non-zero elements) per
+    iteration.
+    :param base_matrix: Markov matrix represented as double nested list, NumPy array or SparseMatrix
+    :param method: Solving method - 'solve' or 'power'
+    :param tolerance: Convergence criterion of power method
+    :param max_iterations: Maximum number of power method iterations
+    :param trace: If True, distribution after every power method iteration is collected
+    :return: Tuple (pi, residual, trace_list) with stationary distribution, highest absolute value of pi * P - pi and
+    list of consecutive distributions (empty if trace is False)
+    """
+    # initial variables
+    if isinstance(base_matrix, SparseMatrix):
+        matrix = base_matrix
+        states: int = matrix.states
+        multiply = vector_times_sparse
+    else:
+        matrix = np.asarray(base_matrix, dtype=float)
+        states: int = matrix.shape[0]
+        multiply = np.matmul
+    trace_list: list = []
+
+    # main function logic
+    if method == 'solve' and isinstance(matrix, SparseMatrix):
+        raise ValueError("Method 'solve' needs dense matrix, use method 'power' for sparse one")
+    elif method == 'solve':
+        equations = matrix.T - np.eye(states)
+        equations[-1] = 1.0  # normalization replaces one (redundant) balance equation
+        right_side = np.zeros(states)
+        right_side[-1] = 1.0
+        pi = np.linalg.solve(equations, right_side)
+        if trace:
+            trace_list.append(pi)
+    elif method == 'power':
+        pi = np.full(states, 1.0 / states)
+        for _ in range(max_iterations):
+            next_pi = multiply(pi, matrix)
+            if trace:
+                trace_list.append(next_pi)
+            converged = np.max(np.abs(next_pi - pi)) < tolerance
+            pi = next_pi
+            if converged:
+                break
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    return pi, float(np.max(np.abs(multiply(pi, matrix) - pi))), trace_list
+
+
 def calculation_handler(convergence_criterion: float) -> tuple:
     """
     Function for handling matrix by matrix multiplication and performing main calculations.
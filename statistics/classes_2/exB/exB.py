@@ -5,16 +5,123 @@
 # Script will show experimental results (theoretical results in script A).
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
+import bisect
+import os
+import pickle
+from array import array
+from typing import NamedTuple
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 
 
-def calculations_handler(x_pos: int, iterations: int, leap: int) -> list:
+class SparseMatrix(NamedTuple):
     """
-    Function for performing experimental calculations.
-    :param x_pos: Starting node
+    Transition matrix in compressed sparse row (CSR) format - memory proportional to number of non-zero elements.
+    Non-zero elements of row i are data[indptr[i]:indptr[i + 1]], placed in columns indices[indptr[i]:indptr[i + 1]].
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    states: int
+
+
+def sparse_from_triplets(rows, cols, values, states: int) -> SparseMatrix:
+    """
+    Function for building sparse matrix from (row, column, value) triplets. Repeated positions are summed.
+    :param rows: Row index of each non-zero element
+    :param cols: Column index of each non-zero element
+    :param values: Value of each non-zero element
+    :param states: Number of states (matrix is states x states)
+    :return: Sparse matrix
+    """
+    # initial variables
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+
+    # main function logic
+    order = np.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])  # first occurrence of every position
+    starts = np.flatnonzero(first)
+    values = np.add.reduceat(values, starts) if len(starts) else values
+    rows, cols = rows[starts], cols[starts]
+    indptr = np.zeros(states + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=states), out=indptr[1:])
+    return SparseMatrix(indptr=indptr, indices=cols, data=values, states=states)
+
+
+def sparse_from_dense(matrix) -> SparseMatrix:
+    """
+    Function for converting dense matrix (double nested list or NumPy array) to sparse matrix.
+    :param matrix: Dense matrix
+    :return: Sparse matrix
+    """
+    rows, cols = np.nonzero(np.asarray(matrix, dtype=float))
+    return sparse_from_triplets(rows, cols, np.asarray(matrix, dtype=float)[rows, cols], len(matrix))
+
+
+def save_checkpoint(checkpoint_path: str, state: dict, new_results: array) -> None:
+    """
+    Function for saving simulation state to binary checkpoint file. Results are kept in separate raw file (checkpoint
+    path + '.results') and only rows added since previous checkpoint are appended there, so cost of single checkpoint
+    does not grow with length of the run. Size of valid part of results file is saved in the state, which is replaced
+    atomically - a run killed while saving leaves the previous checkpoint intact.
+    :param checkpoint_path: Path to checkpoint file
+    :param state: Dictionary with simulation state (counters, random state)
+    :param new_results: Results (rows one after another) calculated since previous checkpoint
+    :return: None
+    """
+    with open(checkpoint_path + '.results', 'ab') as file:
+        new_results.tofile(file)
+        state['results_size'] = file.tell()
+    with open(checkpoint_path + '.tmp', 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path: str, parameters: dict):
+    """
+    Function for loading simulation state from binary checkpoint file, with results read from results file (as
+    array('d') under 'results' key). Checkpoint made with different simulation parameters is rejected, so results of
+    two different runs are never mixed. Results file is cut to the size saved in checkpoint (rows appended by a run
+    killed before saving the state are dropped) or removed if there is no checkpoint.
+    :param checkpoint_path: Path to checkpoint file
+    :param parameters: Parameters of current simulation, which have to be the same as saved in checkpoint
+    :return: Dictionary with simulation state or None if there is no checkpoint
+    """
+    if checkpoint_path is None:
+        return None
+    if not os.path.exists(checkpoint_path):
+        if os.path.exists(checkpoint_path + '.results'):
+            os.remove(checkpoint_path + '.results')
+        return None
+    with open(checkpoint_path, 'rb') as file:
+        checkpoint = pickle.load(file)
+    if checkpoint['parameters'] != parameters:
+        raise ValueError(f"Checkpoint {checkpoint_path} was made with parameters {checkpoint['parameters']}, "
+                         f"not {parameters}")
+    checkpoint['results'] = array('d')
+    with open(checkpoint_path + '.results', 'r+b') as file:
+        file.truncate(checkpoint['results_size'])
+        checkpoint['results'].fromfile(file, checkpoint['results_size'] // checkpoint['results'].itemsize)
+    return checkpoint
+
+
+def calculations_handler(x_pos: int, iterations: int, leap: int, checkpoint_path: str = None,
+                         checkpoint_every: int = 100000) -> list:
+    """
+    Function for performing experimental calculations. If checkpoint path is given, state of calculations (counters,
+    current node, random state and results) is saved there periodically and calculations continue from existing
+    checkpoint - so a killed run can be resumed and a finished one extended to more iterations, with results identical
+    to an uninterrupted run.
+    :param x_pos: Starting node (ignored when resuming from checkpoint)
     :param iterations: Number of node changes performed
     :param leap: Number of iterations after which current dictionary status will be saved to results list
+    :param checkpoint_path: Path to checkpoint file (no checkpoints if not given)
+    :param checkpoint_every: Number of iterations between consecutive checkpoints
     :return: List of list, where internal list represents dictionary status at each consecutive leap
     """
     # initial values
@@ -24,25 +131,223 @@ def calculations_handler(x_pos: int, iterations: int, leap: int) -> list:
                          [0.4, 0.5, 0.1],
                          [0.25, 0.5, 0.25]]  # base Markov matrix used for calculating - can be changed
     chances_states: list = [0, 1, 2]  # list used to keep track of current node and it's transition probabilities
+    first_iter: int = 1
+    saved_rows: int = 0  # number of results rows already in checkpoint
+    parameters: dict = {'leap': leap, 'base_matrix': base_matrix}  # checkpoint has to be made with the same values
+    checkpoint = load_checkpoint(checkpoint_path, parameters)
+    if checkpoint is not None:
+        first_iter = checkpoint['cur_iter'] + 1
+        x_pos, status_dic = checkpoint['x_pos'], checkpoint['status_dic']
+        flat_results = checkpoint['results'].tolist()  # rows are stored one after another in single array
+        results = [flat_results[idx:idx + len(status_dic)] for idx in range(0, len(flat_results), len(status_dic))]
+        saved_rows = len(results)
+        random.setstate(checkpoint['random_state'])
 
     # main function logic
-    for cur_iter in range(1, iterations + 1):
+    for cur_iter in range(first_iter, iterations + 1):
         current_chances = base_matrix[x_pos]
         x_pos = random.choices(chances_states, current_chances)[0]
         status_dic[x_pos] += 1
         if cur_iter % leap == 0:
             current_x_list = [x / cur_iter for x in status_dic.values()]
             results.append(current_x_list)
+        if checkpoint_path is not None and (cur_iter % checkpoint_every == 0 or cur_iter == iterations):
+            save_checkpoint(checkpoint_path, {'parameters': parameters, 'cur_iter': cur_iter, 'x_pos': x_pos,
+                                              'status_dic': status_dic, 'random_state': random.getstate()},
+                            array('d', (x for row in results[saved_rows:] for x in row)))
+            saved_rows = len(results)
+    return results
+
+
+def build_alias_table(matrix) -> tuple:
+    """
+    Function for building Vose alias table for every row of transition matrix. Next node from node x is then drawn in
+    O(1): pick column c uniformly, keep it with probability prob[x][c], otherwise jump to alias[x][c].
+    :param matrix: Markov matrix represented as double nested list or NumPy array
+    :return: Tuple (prob, alias) of NumPy arrays with the same shape as matrix
+    """
+    # initial variables
+    matrix = np.asarray(matrix, dtype=float)
+    states: int = matrix.shape[1]
+    prob = np.ones(matrix.shape)
+    alias = np.tile(np.arange(states), (matrix.shape[0], 1))
+
+    # main function logic
+    for row_idx, row in enumerate(matrix):
+        scaled = (row * states / row.sum()).tolist()
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[row_idx, less] = scaled[less]
+            alias[row_idx, less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+    return prob, alias
+
+
+def calculations_handler_alias(x_pos: int, iterations: int, leap: int, base_matrix=None, block_size: int = 65536,
+                               rng: np.random.Generator = None) -> list:
+    """
+    Function for performing experimental calculations with alias table sampler. Uniforms are generated in blocks and
+    each one is turned into next node with O(1) alias lookup in the row of current node only, so cost of single
+    iteration does not depend on number of nodes. For tiny chains (up to 16 nodes) the lookup is done for all nodes at
+    once instead, giving one transition map per iteration, and the walk through a block is found by composing these
+    maps with parallel prefix (log2 of block length array passes) - block is then shortened so that the maps take at
+    most 2^22 cells.
+    :param x_pos: Starting node
+    :param iterations: Number of node changes performed
+    :param leap: Number of iterations after which current dictionary status will be saved to results list
+    :param base_matrix: Markov matrix used for calculating (matrix from calculations_handler if not given)
+    :param block_size: Number of iterations performed with single block of uniforms
+    :param rng: NumPy random generator used for drawing uniforms (new unseeded generator if not given)
+    :return: List of list, where internal list represents dictionary status at each consecutive leap
+    """
+    # initial values
+    rng = np.random.default_rng() if rng is None else rng
+    base_matrix = [[0.64, 0.32, 0.04],
+                   [0.4, 0.5, 0.1],
+                   [0.25, 0.5, 0.25]] if base_matrix is None else base_matrix
+    prob, alias = build_alias_table(base_matrix)
+    states: int = prob.shape[0]
+    prob_flat = array('d', prob.ravel().tobytes())  # row of node x starts at x * states
+    alias_flat = array('q', alias.astype(np.int64).ravel().tobytes())
+    compose: bool = states <= 16  # map composition fast path for tiny chains
+    block_size = min(block_size, 2 ** 22 // states) if compose else block_size
+    visits = np.zeros(states, dtype=np.int64)  # collecting information on the number of nodes visits
+    results: list = []
+    done: int = 0  # number of iterations already performed
+
+    # main function logic
+    while done < iterations:
+        current_block = min(block_size, iterations - done)
+        scaled = rng.random(current_block) * states
+        if compose:
+            columns = scaled.astype(np.int64)
+            keep = (scaled - columns)[None, :] < prob[:, columns]
+            maps = np.where(keep, columns[None, :], alias[:, columns]).astype(np.int32)  # maps[x, t] - next from x
+            flat_idx = np.arange(current_block, dtype=np.int32)
+            shift = 1
+            while shift < current_block:  # maps[:, t] becomes composition of all maps up to iteration t
+                maps[:, shift:] = maps.ravel()[maps[:, :-shift] * current_block + flat_idx[shift:]]
+                shift *= 2
+            path = maps[x_pos]
+        else:
+            path_list: list = []
+            for value in scaled.tolist():
+                column = int(value)
+                cell = x_pos * states + column
+                x_pos = column if value - column < prob_flat[cell] else alias_flat[cell]
+                path_list.append(x_pos)
+            path = np.array(path_list, dtype=np.int32)
+        x_pos = int(path[-1])
+
+        # save visits fractions at each leap inside the block
+        previous = 0
+        for checkpoint in range(leap - done % leap, current_block + 1, leap):  # iterations counted from block start
+            visits += np.bincount(path[previous:checkpoint], minlength=states)
+            results.append((visits / (done + checkpoint)).tolist())
+            previous = checkpoint
+        visits += np.bincount(path[previous:], minlength=states)
+        done += current_block
+    return results
+
+
+def calculations_handler_ensemble(walkers: int, iterations: int, leap: int, x_pos: int = 0,
+                                  start_distribution: list = None, base_matrix=None, z: float = 1.96,
+                                  rng: np.random.Generator = None) -> tuple:
+    """
+    Function for performing experimental calculations for ensemble of independent walkers advanced together as NumPy
+    arrays (one alias table draw per walker per iteration).
+    :param walkers: Number of independent walkers
+    :param iterations: Number of node changes performed by each walker
+    :param leap: Number of iterations after which current status will be saved to results list
+    :param x_pos: Starting node of every walker (used if start_distribution is not given)
+    :param start_distribution: Probabilities of starting in each node, drawn independently for every walker
+    :param base_matrix: Markov matrix used for calculating (matrix from calculations_handler if not given)
+    :param z: Quantile of standard normal distribution for confidence bands (1.96 for 95%)
+    :param rng: NumPy random generator used for drawing (new unseeded generator if not given)
+    :return: Tuple (results, bands), where internal lists of results represent nodes visits fractions averaged over
+    walkers at each consecutive leap and internal lists of bands represent half-widths of their confidence intervals
+    """
+    # initial values
+    rng = np.random.default_rng() if rng is None else rng
+    base_matrix = [[0.64, 0.32, 0.04],
+                   [0.4, 0.5, 0.1],
+                   [0.25, 0.5, 0.25]] if base_matrix is None else base_matrix
+    prob, alias = build_alias_table(base_matrix)
+    states: int = prob.shape[0]
+    if start_distribution is None:
+        positions = np.full(walkers, x_pos, dtype=np.int64)
+    else:
+        positions = rng.choice(states, size=walkers, p=start_distribution)
+    visits = np.zeros((walkers, states), dtype=np.int64)  # number of nodes visits of each walker
+    walker_idx = np.arange(walkers)
+    results: list = []
+    bands: list = []
+
+    # main function logic
+    for cur_iter in range(1, iterations + 1):
+        scaled = rng.random(walkers) * states
+        columns = scaled.astype(np.int64)
+        positions = np.where(scaled - columns < prob[positions, columns], columns, alias[positions, columns])
+        visits[walker_idx, positions] += 1
+        if cur_iter % leap == 0:
+            fractions = visits / cur_iter
+            results.append(fractions.mean(axis=0).tolist())
+            spread = fractions.std(axis=0, ddof=1) if walkers > 1 else np.zeros(states)
+            bands.append((z * spread / np.sqrt(walkers)).tolist())
+    return results, bands
+
+
+def calculations_handler_sparse(transition_matrix: SparseMatrix, x_pos: int, iterations: int, leap: int,
+                                states_to_track: list = None) -> list:
+    """
+    Function for performing experimental calculations on sparse transition matrix. Next node is found by bisection in
+    cumulative probabilities of current node's non-zero transitions only, so memory and time per iteration do not
+    depend on number of states.
+    :param transition_matrix: Sparse Markov matrix
+    :param x_pos: Starting node
+    :param iterations: Number of node changes performed
+    :param leap: Number of iterations after which current status of tracked nodes will be saved to results list
+    :param states_to_track: Nodes which visits are saved to results list (all nodes if not given)
+    :return: List of list, where internal list represents tracked nodes visits fractions at each consecutive leap
+    """
+    # initial values
+    states_to_track = range(transition_matrix.states) if states_to_track is None else states_to_track
+    visits_array = np.zeros(transition_matrix.states, dtype=np.int64)  # number of visits of each node
+    results: list = []
+    empty_rows = np.flatnonzero(np.diff(transition_matrix.indptr) == 0)
+    if len(empty_rows):
+        raise ValueError(f"Node {empty_rows[0]} has no transitions")
+    cumulative_array = np.empty(len(transition_matrix.data))  # cumulative probabilities of each row, from 0 in each
+    for start, end in zip(transition_matrix.indptr[:-1].tolist(), transition_matrix.indptr[1:].tolist()):
+        np.cumsum(transition_matrix.data[start:end], out=cumulative_array[start:end])
+    # memory views give Python scalars on indexing without copying arrays to lists
+    indptr = memoryview(np.ascontiguousarray(transition_matrix.indptr, dtype=np.int64))
+    indices = memoryview(np.ascontiguousarray(transition_matrix.indices, dtype=np.int64))
+    cumulative = memoryview(cumulative_array)
+    visits = memoryview(visits_array)
+
+    # main function logic
+    for cur_iter in range(1, iterations + 1):
+        start, end = indptr[x_pos], indptr[x_pos + 1]
+        target = random.random() * cumulative[end - 1]
+        x_pos = indices[min(bisect.bisect_right(cumulative, target, start, end), end - 1)]
+        visits[x_pos] += 1
+        if cur_iter % leap == 0:
+            results.append([visits[x] / cur_iter for x in states_to_track])
     return results
 
 
-def show_graph(elements: list, num_of_iterations: int, leap: int) -> None:
+def show_graph(elements: list, num_of_iterations: int, leap: int, bands: list = None) -> None:
     """
     Function for drawing graph adequate to received data.
     :param leap: Number of iterations after which dictionary status will be saved to results list
     :param elements: List of matrix elements where each internal list represents changes in single field of original
     matrix
     :param num_of_iterations: Number of iterations (node changes) to perform
+    :param bands: Half-widths of confidence bands in the same layout as elements (no bands if not given)
     :return: None
     """
     # initial variables
@@ -53,6 +358,10 @@ def show_graph(elements: list, num_of_iterations: int, leap: int) -> None:
     for idx, (results, color) in enumerate(zip(elements, colors)):
         y_pos = range(len(results))
         plt.plot(y_pos, results, color=color, label=f"x. = {idx}")
+        if bands is not None:
+            lower = [value - band for value, band in zip(results, bands[idx])]
+            upper = [value + band for value, band in zip(results, bands[idx])]
+            plt.fill_between(y_pos, lower, upper, color=color, alpha=0.2)
     plt.grid(zorder=0, axis='y')
     plt.xticks(range(0, round(num_of_iterations / leap) + 1, round(num_of_iterations / (leap * 10))),  # values to index
                range(0, num_of_iterations + 1, round(num_of_iterations // 10)))  # values to show
@@ -6,63 +6,304 @@
 # state is 5, and so on. On the graph we show can show selected states.
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
+import os
+import pickle
 import random
+from array import array
+import numpy as np
 import matplotlib.pyplot as plt
 
 
-def change_state(users_list: list, iterations: int, x_to_track: int, leap: int) -> list:
+def save_checkpoint(checkpoint_path: str, state: dict, new_results: array) -> None:
+    """
+    Function for saving simulation state to binary checkpoint file. Results are kept in separate raw file (checkpoint
+    path + '.results') and only rows added since previous checkpoint are appended there, so cost of single checkpoint
+    does not grow with length of the run. Size of valid part of results file is saved in the state, which is replaced
+    atomically - a run killed while saving leaves the previous checkpoint intact.
+    :param checkpoint_path: Path to checkpoint file
+    :param state: Dictionary with simulation state (counters, random state)
+    :param new_results: Results (rows one after another) calculated since previous checkpoint
+    :return: None
+    """
+    with open(checkpoint_path + '.results', 'ab') as file:
+        new_results.tofile(file)
+        state['results_size'] = file.tell()
+    with open(checkpoint_path + '.tmp', 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path: str, parameters: dict):
+    """
+    Function for loading simulation state from binary checkpoint file, with results read from results file (as
+    array('d') under 'results' key). Checkpoint made with different simulation parameters is rejected, so results of
+    two different runs are never mixed. Results file is cut to the size saved in checkpoint (rows appended by a run
+    killed before saving the state are dropped) or removed if there is no checkpoint.
+    :param checkpoint_path: Path to checkpoint file
+    :param parameters: Parameters of current simulation, which have to be the same as saved in checkpoint
+    :return: Dictionary with simulation state or None if there is no checkpoint
+    """
+    if checkpoint_path is None:
+        return None
+    if not os.path.exists(checkpoint_path):
+        if os.path.exists(checkpoint_path + '.results'):
+            os.remove(checkpoint_path + '.results')
+        return None
+    with open(checkpoint_path, 'rb') as file:
+        checkpoint = pickle.load(file)
+    if checkpoint['parameters'] != parameters:
+        raise ValueError(f"Checkpoint {checkpoint_path} was made with parameters {checkpoint['parameters']}, "
+                         f"not {parameters}")
+    checkpoint['results'] = array('d')
+    with open(checkpoint_path + '.results', 'r+b') as file:
+        file.truncate(checkpoint['results_size'])
+        checkpoint['results'].fromfile(file, checkpoint['results_size'] // checkpoint['results'].itemsize)
+    return checkpoint
+
+
+def change_users_state(users_list: list) -> int:
+    """
+    Function for performing single state change of every user in given list.
+    :param users_list: List of users (0 - logged out, 1 - logged in), changed in place
+    :return: Current state - number of logged in users
+    """
+    # initial variables
+    chances_population: list = [0, 1]  # list for tracking if each user state: 0 - logged out, 1 - logged in
+    chances_not_logged: list = [0.8, 0.2]  # probabilities to [stay logged out, log in] when user is not logged in
+    chances_logged: list = [0.5, 0.5]  # probabilities to [stay logged in, log out] when user is logged in
+
+    # main function logic
+    for idx, user in enumerate(users_list):
+        if user == 0:
+            users_list[idx] = random.choices(chances_population, chances_not_logged)[0]
+        else:
+            users_list[idx] = random.choices(chances_population, chances_logged)[0]
+    return sum(users_list)  # sum number of 1's in list - number of logged in users
+
+
+def change_users_state_vectorized(users: np.ndarray, rng: np.random.Generator) -> int:
+    """
+    Function for performing single state change of all users at once - single uniform per user and login/logout
+    probability chosen by mask of currently logged in users.
+    :param users: Boolean NumPy array of users (True - logged in), changed in place
+    :param rng: NumPy random generator used for drawing
+    :return: Current state - number of logged in users
+    """
+    # initial variables
+    login_chance: float = 0.2  # probability to log in when user is not logged in
+    stay_logged_chance: float = 0.5  # probability to stay logged in when user is logged in
+
+    # main function logic
+    draws = rng.random(users.size)
+    users[:] = np.where(users, draws < stay_logged_chance, draws < login_chance)
+    return int(np.count_nonzero(users))
+
+
+def change_logged_count(num_of_users: int, current_x: int, rng: np.random.Generator) -> int:
+    """
+    Function for performing single state change when only the number of logged in users is tracked. Users are
+    exchangeable, so next state is the number of logins among logged out users plus the number of users staying logged
+    in - sum of two binomial draws, with O(1) cost whatever the number of users.
+    :param num_of_users: Number of users
+    :param current_x: Current state (number of logged in users)
+    :param rng: NumPy random generator used for drawing
+    :return: Next state - number of logged in users
+    """
+    # initial variables
+    login_chance: float = 0.2  # probability to log in when user is not logged in
+    stay_logged_chance: float = 0.5  # probability to stay logged in when user is logged in
+
+    # main function logic
+    return int(rng.binomial(num_of_users - current_x, login_chance) + rng.binomial(current_x, stay_logged_chance))
+
+
+def change_state(users_list: list, iterations: int, x_to_track: int, leap: int, checkpoint_path: str = None,
+                 checkpoint_every: int = 100000) -> list:
     """
     Function for performing number of states changes for given user list.
     :param users_list: List of users for which we change states
     :param iterations: Number of state changes for each user
     :param x_to_track: Number of state to track
     :param leap: Number of iterations after which current dictionary status will be saved to results list
+    :param checkpoint_path: Path to checkpoint file (no checkpoints if not given, see change_state_all)
+    :param checkpoint_every: Number of iterations between consecutive checkpoints
     :return: List of tracked state Pi values at each consecutive leap
     """
+    return change_state_all(users_list, iterations, leap, xs_to_track=(x_to_track,), checkpoint_path=checkpoint_path,
+                            checkpoint_every=checkpoint_every)[:, 0].tolist()
+
+
+def change_state_all(users, iterations: int, leap: int, mode: str = 'list', xs_to_track=None,
+                     rng: np.random.Generator = None, checkpoint_path: str = None,
+                     checkpoint_every: int = 100000) -> np.ndarray:
+    """
+    Function for performing number of states changes in a single pass, recording Pi values of tracked states at each
+    leap into preallocated 2-D array. Only visited states are counted and in 'lumped' mode states to track have to be
+    given, so there time and memory do not depend on number of users. If checkpoint path is given, state of
+    calculations (users, counters, random states and results) is saved there periodically and calculations continue
+    from existing checkpoint - so a killed run can be resumed and a finished one extended to more iterations, with
+    results identical to an uninterrupted run.
+    :param users: List of users for which we change states (changed in place in 'list' mode) or number of users (all
+    logged out at start) - in 'lumped' mode only the number is needed
+    :param iterations: Number of state changes for each user
+    :param leap: Number of iterations after which current status of tracked states will be saved
+    :param mode: Update method: 'list' (change_users_state), 'vectorized' (change_users_state_vectorized) or 'lumped'
+    (change_logged_count)
+    :param xs_to_track: States to record (all states 0 ... number of users if not given, which is not allowed in
+    'lumped' mode)
+    :param rng: NumPy random generator used in 'vectorized' and 'lumped' modes (new unseeded generator if not given)
+    :param checkpoint_path: Path to checkpoint file (no checkpoints if not given)
+    :param checkpoint_every: Number of iterations between consecutive checkpoints
+    :return: Array where row k contains Pi values of tracked states at leap k + 1
+    """
     # initial variables
-    status_dic: dict = {x: 0 for x in range(len(users_list) + 1)}  # collecting number of occurrences of a given state
-    chances_population: list = [0, 1]  # list for tracking if each user state: 0 - logged out, 1 - logged in
-    chances_not_logged: list = [0.8, 0.2]  # probabilities to [stay logged out, log in] when user is not logged in
-    chances_logged: list = [0.5, 0.5]  # probabilities to [stay logged in, log out] when user is logged in
-    results: list = []
+    if mode == 'lumped' and xs_to_track is None:
+        raise ValueError("States to track have to be given in 'lumped' mode")
+    rng = np.random.default_rng() if rng is None else rng
+    num_of_users: int = users if isinstance(users, int) else len(users)
+    users = [0 for _ in range(num_of_users)] if isinstance(users, int) and mode != 'lumped' else users
+    current_x: int = 0 if isinstance(users, int) else int(sum(users))
+    users_array = np.array(users, dtype=bool) if mode == 'vectorized' else None
+    xs_to_track = range(num_of_users + 1) if xs_to_track is None else xs_to_track
+    status_dic: dict = {}  # collecting number of occurrences of a given state (only visited states are kept)
+    results = np.empty((iterations // leap, len(xs_to_track)))
+    first_iteration: int = 1
+    saved_rows: int = 0  # number of results rows already in checkpoint
+    parameters: dict = {'mode': mode, 'num_of_users': num_of_users, 'leap': leap, 'xs_to_track': list(xs_to_track)}
+    checkpoint = load_checkpoint(checkpoint_path, parameters)
+    if checkpoint is not None:
+        first_iteration = checkpoint['iteration'] + 1
+        current_x, status_dic = checkpoint['current_x'], checkpoint['status_dic']
+        if mode == 'list':
+            users[:] = list(checkpoint['users'])
+        elif mode == 'vectorized':
+            users_array = np.frombuffer(checkpoint['users'], dtype=bool).copy()
+        saved_results = np.array(checkpoint['results']).reshape(-1, len(xs_to_track))
+        results[:len(saved_results)] = saved_results
+        saved_rows = len(saved_results)
+        random.setstate(checkpoint['random_state'])
+        rng.bit_generator.state = checkpoint['rng_state']
 
     # main function logic
-    for iteration in range(1, iterations + 1):
-        for idx, user in enumerate(users_list):
-            if user == 0:
-                users_list[idx] = random.choices(chances_population, chances_not_logged)[0]
-            else:
-                users_list[idx] = random.choices(chances_population, chances_logged)[0]
-        status_dic[sum(users_list)] += 1  # sum number of 1's in list - number of logged in users (current state)
+    for iteration in range(first_iteration, iterations + 1):
+        if mode == 'list':
+            current_x = change_users_state(users)
+        elif mode == 'vectorized':
+            current_x = change_users_state_vectorized(users_array, rng)
+        else:
+            current_x = change_logged_count(num_of_users, current_x, rng)
+        status_dic[current_x] = status_dic.get(current_x, 0) + 1
         if iteration % leap == 0:
-            results.append(status_dic[x_to_track] / iteration)
+            results[iteration // leap - 1] = [status_dic.get(x, 0) / iteration for x in xs_to_track]
+        if checkpoint_path is not None and (iteration % checkpoint_every == 0 or iteration == iterations):
+            users_bytes = bytes(users) if mode == 'list' else users_array.tobytes() if mode == 'vectorized' else b''
+            save_checkpoint(checkpoint_path, {'parameters': parameters, 'iteration': iteration,
+                                              'current_x': current_x, 'users': users_bytes, 'status_dic': status_dic,
+                                              'random_state': random.getstate(), 'rng_state': rng.bit_generator.state},
+                            array('d', results[saved_rows:iteration // leap].tobytes()))
+            saved_rows = iteration // leap
     return results
 
 
-def show_graph(num_of_iterations: int, users: list, leap: int, xs_to_track: tuple) -> None:
+def binomial_distribution(trials: int, chance: float, log_factorials: np.ndarray) -> np.ndarray:
+    """
+    Function for calculating probabilities of every number of successes in binomial distribution (in log space).
+    :param trials: Number of trials
+    :param chance: Probability of success in single trial
+    :param log_factorials: Array with ln(k!) for k = 0 ... at least trials
+    :return: Array where element with index k is probability of k successes
+    """
+    # distributions with known result
+    if chance <= 0 or chance >= 1:
+        probabilities = np.zeros(trials + 1)
+        probabilities[trials if chance >= 1 else 0] = 1.0
+        return probabilities
+
+    # main function logic
+    successes = np.arange(trials + 1)
+    return np.exp(log_factorials[trials] - log_factorials[successes] - log_factorials[trials - successes] +
+                  successes * np.log(chance) + (trials - successes) * np.log1p(-chance))
+
+
+def build_transition_matrix(num_of_users: int) -> np.ndarray:
+    """
+    Function for building exact transition matrix of the number of logged in users. Row x is distribution of
+    Binomial(N - x, 0.2) + Binomial(x, 0.5) (logins among logged out users plus users staying logged in) - convolution
+    of two binomial distributions.
+    :param num_of_users: Number of users N
+    :return: Transition matrix (N + 1) x (N + 1)
+    """
+    # initial variables
+    log_factorials = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, num_of_users + 1)))))
+    matrix = np.empty((num_of_users + 1, num_of_users + 1))
+    login_chance: float = 0.2  # probability to log in when user is not logged in
+    stay_logged_chance: float = 0.5  # probability to stay logged in when user is logged in
+
+    # main function logic
+    for current_x in range(num_of_users + 1):
+        matrix[current_x] = np.convolve(binomial_distribution(num_of_users - current_x, login_chance, log_factorials),
+                                        binomial_distribution(current_x, stay_logged_chance, log_factorials))
+    return matrix
+
+
+def stationary_distribution(matrix: np.ndarray) -> tuple:
+    """
+    Function for finding stationary distribution pi (pi * P = pi, sum of pi = 1) of transition matrix by solving
+    linear system (P^T - I) * pi = 0 with one equation replaced by normalization.
+    :param matrix: Transition matrix
+    :return: Tuple (pi, residual) with stationary distribution and highest absolute value of pi * P - pi
+    """
+    # initial variables
+    states: int = matrix.shape[0]
+    equations = matrix.T - np.eye(states)
+    right_side = np.zeros(states)
+
+    # main function logic
+    equations[-1] = 1.0  # normalization replaces one (redundant) balance equation
+    right_side[-1] = 1.0
+    pi = np.linalg.solve(equations, right_side)
+    return pi, float(np.max(np.abs(pi @ matrix - pi)))
+
+
+def show_graph(num_of_iterations: int, users: list, leap: int, xs_to_track: tuple,
+               vectorized: bool = False, lumped: bool = False, exact: bool = False, checkpoint_path: str = None,
+               checkpoint_every: int = 100000) -> None:
     """
     Function for drawing graph adequate to received data.
     :param num_of_iterations: Number of each user login status possible changes
-    :param users: List of users for which login status will be changed
+    :param users: List of users for which login status will be changed (number of users is enough in lumped mode)
     :param leap: Number of iterations after which dictionary status will be saved to results list
     :param xs_to_track: Number of states to track
+    :param vectorized: If True, users are kept in boolean array and updated at once (change_users_state_vectorized)
+    :param lumped: If True, only number of logged in users is simulated (change_logged_count)
+    :param exact: If True, exact stationary Pi values of tracked states are drawn as dashed lines
+    :param checkpoint_path: Path to checkpoint file used to save and resume simulation (no checkpoints if not given)
+    :param checkpoint_every: Number of iterations between consecutive checkpoints
     :return: None
     """
     # initial variables
     colors = ('red', 'black', 'green', 'blue', 'orange', 'olive', 'grey', 'brown', 'cyan', 'purple', 'pink')
+    mode: str = 'lumped' if lumped else 'vectorized' if vectorized else 'list'
+    num_of_users: int = users if isinstance(users, int) else len(users)
+    all_results = change_state_all(users, num_of_iterations, leap, mode=mode, xs_to_track=xs_to_track,
+                                   checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)  # one pass
 
     # draw graph
-    for x, color in zip(xs_to_track, colors):
-        results = change_state(users, num_of_iterations, x, leap)  # calculate Pi values for each state
+    for column, (x, color) in enumerate(zip(xs_to_track, colors)):
+        results = all_results[:, column]
         y_pos = range(len(results))
         plt.plot(y_pos, results, color=color, label=f"x = {x}")
+    if exact:
+        pi, _ = stationary_distribution(build_transition_matrix(num_of_users))
+        for x, color in zip(xs_to_track, colors):
+            plt.axhline(pi[x], color=color, linestyle='--', linewidth=0.8)
 
     plt.grid(zorder=0, axis='y')
     plt.xticks(range(0, round(num_of_iterations / leap) + 1, round(num_of_iterations / (leap * 10))),  # values to index
                range(0, num_of_iterations + 1, round(num_of_iterations // 10)))  # values to show
     plt.ylabel(f"Experimental Pi values")
     plt.xlabel(f"Number of iterations: {num_of_iterations}, leap every: {leap}")
-    plt.title(f"Markov matrix graph example experimental - {len(users)} users/states", loc='left')
+    plt.title(f"Markov matrix graph example experimental - {num_of_users} users/states", loc='left')
     plt.legend()
     plt.savefig(f"example1.png")
     plt.show()
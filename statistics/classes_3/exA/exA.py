@@ -2,37 +2,102 @@
 # First version with a limitation in the form of the number of tasks that should appear in the system
 # Author: Kamil Czerwiński, Jagiellonian University, CS 2020/2021
 
-import math
-import random
+import bisect
+import heapq
+from collections import deque
+import numpy as np
 import matplotlib.pyplot as plt
 
 
-def calculate_poisson(lambda_a: float, lambda_s: float) -> tuple:
+def generate_variates(distribution: str, size: int, rng: np.random.Generator, **params) -> np.ndarray:
     """
-    Function for calculating poisson values, where :'lambda a' is time needed for task to appear in the system,
-    'lambda s' is time needed for system to execute the task.
-    :param lambda_a: Average time of receipt of tasks into the system
-    :param lambda_s: Average time of task execution by the system
-    :return: Tuple (float, float) with poisson values for 'lambda a' and 'lambda s'
+    Function for generating block of random times from given distribution with single generator call. Exponential
+    times are scaled with natural logarithm, so 'rate' is exactly the inverse of the average time.
+    :param distribution: Name of distribution - 'exponential' (param 'rate'), 'deterministic' (param 'value'),
+    'lognormal' (params 'mean' and 'sigma' of underlying normal distribution) or 'empirical' (param 'values' - sample of
+    observed times drawn with replacement)
+    :param size: Number of generated times
+    :param rng: Numpy random generator
+    :param params: Parameters of given distribution
+    :return: Array with generated times
+    """
+    if distribution == 'exponential':
+        return rng.exponential(1 / params['rate'], size)
+    if distribution == 'deterministic':
+        return np.full(size, float(params['value']))
+    if distribution == 'lognormal':
+        return rng.lognormal(params['mean'], params['sigma'], size)
+    if distribution == 'empirical':
+        return rng.choice(np.asarray(params['values'], dtype=float), size)
+    raise ValueError(f"Unknown distribution: {distribution}")
+
+
+class VariateBuffer:
+    """
+    Iterator returning random times one by one for event-driven simulation. Times are generated in blocks with
+    generate_variates, so there is only one generator call per block.
+    """
+
+    def __init__(self, distribution: str, block_size: int = 4096, rng: np.random.Generator = None, **params):
+        """
+        :param distribution: Name of distribution (see generate_variates)
+        :param block_size: Number of times generated at once
+        :param rng: Numpy random generator (new one is created if not given)
+        :param params: Parameters of given distribution
+        """
+        self.distribution = distribution
+        self.block_size = block_size
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.params = params
+        self._block = iter(())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> float:
+        try:
+            return next(self._block)
+        except StopIteration:
+            self._block = iter(generate_variates(self.distribution, self.block_size, self.rng, **self.params).tolist())
+            return next(self._block)
+
+
+def iterate_queue_after(scheduled_times, ending_times):
+    """
+    Generator calculating queue length when each task is leaving the system. Scheduled and ending times are both
+    non-decreasing, so number of tasks which arrived before given task end is found with single pointer moving along
+    scheduled times (merge of two sorted sequences). Works with any iterables, so times can be streamed.
+    :param scheduled_times: Non-decreasing iterable with scheduled times of the tasks
+    :param ending_times: Non-decreasing iterable with ending times of the tasks
+    :return: Generator with queue length when task with given index is leaving the system
     """
     # initial variables
-    random_u1 = random.random()
-    random_u2 = random.random()
+    scheduled_iter = iter(scheduled_times)
+    next_scheduled = next(scheduled_iter, None)
+    arrived: int = 0  # number of tasks scheduled before current task end
 
     # main function logic
-    while random_u1 == 0 or random_u2 == 0:
-        random_u1 = random.random()
-        random_u2 = random.random()
-    return -(math.log(random_u1, 10) / lambda_a), -(math.log(random_u2, 10) / lambda_s)
+    for counter, element in enumerate(ending_times):
+        while next_scheduled is not None and next_scheduled < element:
+            arrived += 1
+            next_scheduled = next(scheduled_iter, None)
+        temp = arrived - 2 - counter
+        yield temp if temp > 0 else 0
 
 
-def calculate_time(lambda_a: float, lambda_s: float, num_of_tasks: int) -> None:
+def simulate_queue(lambda_a: float, lambda_s: float, num_of_tasks: int, verbose: bool = False,
+                   rng: np.random.Generator = None) -> tuple:
     """
-    Function to simulate system operation with given values. Adequate graph is generated.
-    :param lambda_a: Average time of receipt of tasks into the system
-    :param lambda_s: Average time of task execution by the system
+    Function to simulate system operation with given values. Ending times of the tasks are non-decreasing (single
+    server, tasks are executed in order of arrival), so the number of tasks still in the system when a new one arrives
+    is found by bisection of ending times list instead of scanning all previous tasks.
+    :param lambda_a: Rate of receipt of tasks into the system (average time between arrivals is 1 / lambda_a)
+    :param lambda_s: Rate of task execution by the system (average execution time is 1 / lambda_s)
     :param num_of_tasks: Number of task
-    :return: None
+    :param verbose: Print queue position of each arriving task
+    :param rng: Numpy random generator (new one is created if not given)
+    :return: Tuple (list, list, list, list) with scheduled times, ending times, queue positions when entering the
+    system and queue lengths when leaving the system
     """
     # initial variables
     scheduled_list: list = []  # list with the scheduled start time of the task with given index (task 0 - idx 0)
@@ -42,29 +107,174 @@ def calculate_time(lambda_a: float, lambda_s: float, num_of_tasks: int) -> None:
     queue_list_after: list = []  # list with queue length when task with given index is leaving the system (task 0 -
     # idx 0)
     li_time_sum: int = 0  # sum of time needed to execute all tasks in the system
+    departed: int = 0  # number of tasks which left the system before current task arrival
+    rng = np.random.default_rng() if rng is None else rng
+    arrival_times = VariateBuffer('exponential', rng=rng, rate=lambda_a)
+    service_times = VariateBuffer('exponential', rng=rng, rate=lambda_s)
 
     # main program logic
     for i in range(num_of_tasks):
         # calculate current task arrival, execution time
-        ti_current_in, tis_current = (round(x, 3) for x in calculate_poisson(lambda_a, lambda_s))
+        ti_current_in, tis_current = next(arrival_times), next(service_times)
         li_time_sum += ti_current_in  # sum time needed to complete task
 
-        # check current task queue position
-        queue_pos_scheduled = sum(1 for element in ending_time_list if element > li_time_sum)
+        # check current task queue position - tasks with ending time greater than arrival time are still in system
+        departed = bisect.bisect_right(ending_time_list, li_time_sum, departed)
+        queue_pos_scheduled = len(ending_time_list) - departed
         queue_list_scheduled.append(queue_pos_scheduled)
 
         scheduled_list.append(li_time_sum)  # add task starting time
-        if queue_pos_scheduled != 0:  # if task starts immediately
-            ending_time_list.append(ending_time_list[i - 1] + tis_current)
-            print(f"I'm not first, my position in queue is: {queue_pos_scheduled}")
-        else:  # if task is in queue
+        if queue_pos_scheduled != 0:  # if task is in queue
+            ending_time_list.append(ending_time_list[-1] + tis_current)
+            if verbose:
+                print(f"I'm not first, my position in queue is: {queue_pos_scheduled}")
+        else:  # if task starts immediately
             ending_time_list.append(li_time_sum + tis_current)
-            print("I'm first, so I'm starting immediately")
+            if verbose:
+                print("I'm first, so I'm starting immediately")
 
     # calculate queue length when task is leaving the system
-    for counter, element in enumerate(ending_time_list):
-        temp = sum(1 for num in scheduled_list if num < element) - 2 - counter
-        queue_list_after.append(temp if temp > 0 else 0)
+    queue_list_after.extend(iterate_queue_after(scheduled_list, ending_time_list))
+    return scheduled_list, ending_time_list, queue_list_scheduled, queue_list_after
+
+
+def lindley_recursion(scheduled_array: np.ndarray, service_array: np.ndarray) -> tuple:
+    """
+    Function for calculating ending times and queue lengths of all tasks at once. For single server executing tasks in
+    order of arrival ending times follow Lindley recursion D_i = max(A_i, D_(i-1)) + S_i, which unrolled gives
+    D_i = C_i + max_(j<=i)(A_j - C_(j-1)), where C is cumulative sum of execution times - running maximum is calculated
+    with np.maximum.accumulate. Both times are non-decreasing, so queue lengths are found with np.searchsorted.
+    :param scheduled_array: Array with scheduled (arrival) times of the tasks
+    :param service_array: Array with execution times of the tasks
+    :return: Tuple (np.ndarray, np.ndarray, np.ndarray, np.ndarray) with ending times, queue positions when entering the
+    system, queue lengths when leaving the system and waiting times in queue
+    """
+    # initial variables
+    indexes = np.arange(len(scheduled_array))
+    service_sum = np.cumsum(service_array)
+
+    # main function logic
+    ending_array = scheduled_array - service_sum
+    ending_array += service_array  # A_j - C_(j-1)
+    np.maximum.accumulate(ending_array, out=ending_array)
+    ending_array += service_sum
+    del service_sum
+    waiting_array = ending_array - scheduled_array
+    waiting_array -= service_array
+
+    # tasks with ending time greater than arrival time are still in system (only previous tasks can be counted)
+    queue_scheduled = indexes - np.minimum(np.searchsorted(ending_array, scheduled_array, side='right'), indexes)
+    queue_after = np.searchsorted(scheduled_array, ending_array, side='left') - 2 - indexes
+    np.maximum(queue_after, 0, out=queue_after)
+    return ending_array, queue_scheduled, queue_after, waiting_array
+
+
+def simulate_queue_batch(lambda_a: float, lambda_s: float, num_of_tasks: int, rng: np.random.Generator = None) -> tuple:
+    """
+    Function to simulate system operation with given values in batch mode - all arrival and execution times are
+    generated at once and the rest is calculated on whole arrays.
+    :param lambda_a: Rate of receipt of tasks into the system (average time between arrivals is 1 / lambda_a)
+    :param lambda_s: Rate of task execution by the system (average execution time is 1 / lambda_s)
+    :param num_of_tasks: Number of task
+    :param rng: Numpy random generator (new one is created if not given)
+    :return: Tuple (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) with scheduled times, ending times,
+    queue positions when entering the system, queue lengths when leaving the system and waiting times in queue
+    """
+    # initial variables
+    rng = np.random.default_rng() if rng is None else rng
+
+    # main function logic
+    scheduled_array = generate_variates('exponential', num_of_tasks, rng, rate=lambda_a)
+    np.cumsum(scheduled_array, out=scheduled_array)
+    service_array = generate_variates('exponential', num_of_tasks, rng, rate=lambda_s)
+    return (scheduled_array, *lindley_recursion(scheduled_array, service_array))
+
+
+def simulate_queue_servers(arrival_times, service_times, num_of_tasks: int, servers: int = 1,
+                           verbose: bool = False) -> tuple:
+    """
+    Function to simulate system with given number of servers executing tasks in order of arrival. Simulation is driven
+    by priority queue of events (next arrival and departures of tasks being executed - at most servers + 1 events), so
+    each event costs O(log servers). Tasks waiting for a free server are kept in FIFO queue. Arrival and execution
+    times are taken from given iterators (e.g. VariateBuffer with any distribution), so they can be freely changed.
+    With one server and exponential times results are the same as in simulate_queue.
+    :param arrival_times: Iterator with times between consecutive task arrivals
+    :param service_times: Iterator with task execution times
+    :param num_of_tasks: Number of task
+    :param servers: Number of servers executing tasks in parallel
+    :param verbose: Print queue position of each arriving task
+    :return: Tuple (list, list, list, list) with scheduled times, ending times, queue positions (number of tasks in the
+    system) when entering the system and queue lengths (number of waiting tasks) when leaving the system
+    """
+    # initial variables
+    scheduled_list: list = []  # list with the scheduled start time of the task with given index (task 0 - idx 0)
+    ending_time_list: list = []  # list with the ending time of the task with given index (task 0 - idx 0)
+    queue_list_scheduled: list = []  # list with the position of the task with given index  in the queue when
+    # entering the system (task 0 - idx 0)
+    queue_list_after: list = []  # list with queue length when task with given index is leaving the system (task 0 -
+    # idx 0)
+    events: list = [(next(arrival_times), 1, 0)] if num_of_tasks > 0 else []  # heap of (time, event type, task
+    # index) - departures (type 0) are handled before arrivals (type 1) happening at the same time
+    waiting: deque = deque()  # indexes of tasks waiting for free server
+    busy: int = 0  # number of busy servers
+
+    # main program logic
+    while events:
+        time, event_type, idx = heapq.heappop(events)
+        if event_type == 1:  # task arrival
+            scheduled_list.append(time)
+            queue_list_scheduled.append(len(waiting) + busy)
+            ending_time_list.append(None)
+            queue_list_after.append(0)
+            if busy < servers:  # if task starts immediately
+                busy += 1
+                ending_time_list[idx] = time + next(service_times)
+                heapq.heappush(events, (ending_time_list[idx], 0, idx))
+                if verbose:
+                    print("I'm first, so I'm starting immediately")
+            else:  # if task is in queue
+                waiting.append(idx)
+                if verbose:
+                    print(f"I'm not first, my position in queue is: {queue_list_scheduled[idx]}")
+            if idx + 1 < num_of_tasks:
+                heapq.heappush(events, (time + next(arrival_times), 1, idx + 1))
+        else:  # task departure - first waiting task takes the server
+            if waiting:
+                next_idx = waiting.popleft()
+                ending_time_list[next_idx] = time + next(service_times)
+                heapq.heappush(events, (ending_time_list[next_idx], 0, next_idx))
+            else:
+                busy -= 1
+            queue_list_after[idx] = len(waiting)
+    return scheduled_list, ending_time_list, queue_list_scheduled, queue_list_after
+
+
+def calculate_time(lambda_a: float, lambda_s: float, num_of_tasks: int, verbose: bool = True,
+                   batch: bool = False, servers: int = 1) -> None:
+    """
+    Function to simulate system operation with given values. Adequate graph is generated.
+    :param lambda_a: Rate of receipt of tasks into the system (average time between arrivals is 1 / lambda_a)
+    :param lambda_s: Rate of task execution by the system (average execution time is 1 / lambda_s)
+    :param num_of_tasks: Number of task
+    :param verbose: Print queue position of each arriving task (ignored in batch mode)
+    :param batch: Use batch (vectorized) simulation
+    :param servers: Number of servers executing tasks in parallel (batch mode supports only one)
+    :return: None
+    """
+    # main program logic
+    if batch and servers > 1:
+        raise ValueError("Batch mode supports only one server")
+    if batch:
+        scheduled_list, ending_time_list, queue_list_scheduled, queue_list_after = \
+            (array.tolist() for array in simulate_queue_batch(lambda_a, lambda_s, num_of_tasks)[:4])
+    elif servers > 1:
+        rng = np.random.default_rng()
+        scheduled_list, ending_time_list, queue_list_scheduled, queue_list_after = \
+            simulate_queue_servers(VariateBuffer('exponential', rng=rng, rate=lambda_a),
+                                   VariateBuffer('exponential', rng=rng, rate=lambda_s), num_of_tasks, servers, verbose)
+    else:
+        scheduled_list, ending_time_list, queue_list_scheduled, queue_list_after = \
+            simulate_queue(lambda_a, lambda_s, num_of_tasks, verbose)
 
     # draw graph
     # task arrival time dots